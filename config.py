@@ -0,0 +1,38 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from dotenv import load_dotenv
+
+SCOPES = (
+    "user-read-private", "user-read-playback-state", "user-modify-playback-state",
+    "user-read-currently-playing", "playlist-read-private", "playlist-read-collaborative",
+    "playlist-modify-public", "playlist-modify-private", "user-read-recently-played",
+)
+
+@dataclass(frozen=True)
+class Settings:
+    client_id: str | None
+    client_secret: str | None
+    redirect_uri: str | None
+    database_url: str
+    debug: bool
+    spotify_max_concurrency: int
+    web_concurrency: int
+    scopes: tuple[str, ...] = SCOPES
+
+@lru_cache(maxsize=1)
+def settings() -> Settings:
+    """Parses .env once and returns the settings shared by every importer."""
+    load_dotenv()
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise ValueError("No DATABASE_URL found in environment variables. Please set it.")
+    return Settings(
+        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
+        redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
+        database_url=database_url,
+        debug=os.getenv("DEBUG", "0") == "1",
+        spotify_max_concurrency=int(os.getenv("SPOTIFY_MAX_CONCURRENCY", "50")),
+        web_concurrency=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )
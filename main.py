@@ -1,265 +1,565 @@
-import os
-import uuid
-import random
+import asyncio
+import functools
+import time
+from contextlib import asynccontextmanager
 import re
-import json
-import spotipy
+import secrets
+from typing import NamedTuple
+import httpx
+import orjson
+from spotipy.cache_handler import MemoryCacheHandler
 from spotipy.oauth2 import SpotifyOAuth
-from dotenv import load_dotenv
-from starlette.responses import RedirectResponse, Response
+from starlette.responses import HTMLResponse, RedirectResponse
 from starlette.routing import Route
 from mcp.server.fastmcp import FastMCP
 import uvicorn
+from config import settings
 # --- NEW IMPORTS FOR DATABASE ---
-from sqlalchemy import create_engine, Column, String, JSON
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import Column, Index, String, cast, literal_column, select, text, update
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import declarative_base
 
 # --- 1. CONFIGURATION ---
-load_dotenv()
-CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
-CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
-REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
-SCOPES = (
-    "user-read-private user-read-playback-state user-modify-playback-state "
-    "user-read-currently-playing playlist-read-private playlist-read-collaborative "
-    "playlist-modify-public playlist-modify-private user-read-recently-played"
+CONFIG = settings()
+CLIENT_ID = CONFIG.client_id
+CLIENT_SECRET = CONFIG.client_secret
+REDIRECT_URI = CONFIG.redirect_uri
+DEBUG = CONFIG.debug
+SCOPES = CONFIG.scopes
+SPOTIFY_MAX_CONCURRENCY = CONFIG.spotify_max_concurrency
+WEB_CONCURRENCY = CONFIG.web_concurrency
+
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+# A base62 playlist ID, optionally given as a spotify: URI or an open.spotify.com link
+_PLAYLIST_ID_RE = re.compile(
+    r"(?:spotify:playlist:|https?://open\.spotify\.com/(?:[\w-]+/)?playlist/)?([0-9A-Za-z]{22})(?:\?.*)?"
 )
 
 # --- NEW: DATABASE SETUP ---
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise ValueError("No DATABASE_URL found in environment variables. Please set it.")
+DATABASE_URL = CONFIG.database_url
 
-# SQLAlchemy setup
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# SQLAlchemy setup (asyncpg driver, so database I/O doesn't block the event loop)
+ASYNC_DATABASE_URL = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+# asyncpg takes libpq's sslmode (as in hosted ?sslmode=require URLs) as its ssl argument
+if "sslmode" in ASYNC_DATABASE_URL.query:
+    ASYNC_DATABASE_URL = ASYNC_DATABASE_URL.difference_update_query(["sslmode"]).update_query_dict(
+        {"ssl": ASYNC_DATABASE_URL.query["sslmode"]}
+    )
+engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=20, max_overflow=40, pool_pre_ping=True)
+# Shares the pool; single-statement reads don't need a BEGIN/ROLLBACK around them
+autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
 Base = declarative_base()
 
 # SQLAlchemy model for our sessions table
 class SpotifySession(Base):
     __tablename__ = "spotify_sessions"
     session_id = Column(String, primary_key=True, index=True)
-    token_info = Column(JSON)
+    token_info = Column(JSONB, nullable=False)
+
+# Used to find an existing session on re-login. The key is rendered inline rather than
+# as a bind parameter so queries match the expression index exactly.
+refresh_token_expr = SpotifySession.token_info[literal_column("'refresh_token'")].astext
+refresh_token_index = Index("ix_spotify_sessions_refresh_token", refresh_token_expr, unique=True)
 
-# Create the table if it doesn't exist
-Base.metadata.create_all(bind=engine)
+async def init_db():
+    """Creates the table and its indexes if they don't exist. Runs on server startup."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # create_all doesn't alter existing tables; older ones store token_info as nullable json
+        column = (await conn.execute(text(
+            "SELECT data_type, is_nullable FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = 'spotify_sessions' "
+            "AND column_name = 'token_info'"
+        ))).one()
+        if column.data_type != "jsonb":
+            await conn.execute(text(
+                "ALTER TABLE spotify_sessions ALTER COLUMN token_info TYPE jsonb USING token_info::jsonb"
+            ))
+        if column.is_nullable == "YES":
+            await conn.execute(text("ALTER TABLE spotify_sessions ALTER COLUMN token_info SET NOT NULL"))
+        # create_all skips indexes on tables that already exist
+        await conn.run_sync(refresh_token_index.create, checkfirst=True)
+
+async def close_db():
+    """Closes pooled database connections on server shutdown."""
+    await engine.dispose()
 
 # --- 2. AUTHENTICATION & SESSION HELPERS ---
 
-def create_spotify_oauth():
-    """Creates a SpotifyOAuth instance for the authentication flow."""
-    return SpotifyOAuth(
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        redirect_uri=REDIRECT_URI,
-        scope=SCOPES,
+# Only used to build the authorize URL; token requests go through the async client.
+# Tokens live in the database, so spotipy's own cache is kept in memory.
+SP_OAUTH = SpotifyOAuth(
+    client_id=CLIENT_ID,
+    client_secret=CLIENT_SECRET,
+    redirect_uri=REDIRECT_URI,
+    scope=" ".join(SCOPES),
+    cache_handler=MemoryCacheHandler(),
+)
+
+class CachedToken(NamedTuple):
+    access_token: str
+    expires_at: float
+    refresh_token: str
+
+# session_id -> CachedToken. Lets hot tool calls skip the database.
+_token_cache: dict[str, CachedToken] = {}
+TOKEN_CACHE_SIZE = 10_000
+TOKEN_EXPIRY_MARGIN = 60
+
+# Sessions used since their token was last refreshed. Only these are refreshed ahead of
+# expiry, so idle sessions fall back to a lazy refresh on their next call.
+_active_sessions: set[str] = set()
+TOKEN_REFRESH_INTERVAL = 30
+
+def _cache_token(session_id: str, token_info: dict):
+    """Stores a session's token in the cache, evicting the oldest entry when it is full."""
+    _token_cache.pop(session_id, None)
+    if len(_token_cache) >= TOKEN_CACHE_SIZE:
+        evicted = next(iter(_token_cache))
+        del _token_cache[evicted]
+        _active_sessions.discard(evicted)
+    _token_cache[session_id] = CachedToken(
+        token_info["access_token"], token_info["expires_at"], token_info["refresh_token"]
     )
 
-def get_sp_for_session(session_id: str):
+# session_id -> in-flight refresh, so concurrent callers share one Spotify round-trip.
+_refresh_inflight: dict[str, asyncio.Task] = {}
+
+async def _refresh_and_store(session_id: str, refresh_token: str) -> dict:
+    """Refreshes a session's token with Spotify and persists it."""
+    token_info = await request_token({"grant_type": "refresh_token", "refresh_token": refresh_token})
+    # Spotify only returns a refresh token when it rotates it
+    token_info.setdefault("refresh_token", refresh_token)
+    # Merge the refreshed fields into the stored document rather than rewriting it
+    async with engine.begin() as conn:
+        await conn.execute(
+            update(SpotifySession)
+            .where(SpotifySession.session_id == session_id)
+            .values(token_info=SpotifySession.token_info.concat(cast(token_info, JSONB)))
+        )
+    return token_info
+
+async def refresh_session_token(session_id: str, refresh_token: str) -> dict:
     """
-    Given a session_id, retrieve the token from the database, create an authenticated
-    Spotipy client, and return it.
+    Refreshes the token for a session. Concurrent calls for the same session_id wait on
+    the refresh that is already running instead of starting their own.
     """
-    db = SessionLocal()
-    try:
-        db_session = db.query(SpotifySession).filter(SpotifySession.session_id == session_id).first()
-        if not db_session:
-            raise Exception("Invalid or expired session_id. Please log in again via the web interface to get a new one.")
+    task = _refresh_inflight.get(session_id)
+    if task is None:
+        task = asyncio.create_task(_refresh_and_store(session_id, refresh_token))
+        _refresh_inflight[session_id] = task
+        task.add_done_callback(lambda _: _refresh_inflight.pop(session_id, None))
+    return await asyncio.shield(task)
+
+async def get_token_for_session(session_id: str) -> str:
+    """
+    Given a session_id, retrieve the token from the cache or the database, refreshing
+    it if needed, and return a valid access token.
+    """
+    now = time.time()
+    entry = _token_cache.get(session_id)
+    if entry and entry.expires_at > now + TOKEN_EXPIRY_MARGIN:
+        _active_sessions.add(session_id)
+        return entry.access_token
 
-        token_info = db_session.token_info
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(
+            select(SpotifySession.token_info).where(SpotifySession.session_id == session_id)
+        )
+        token_info = result.scalar_one_or_none()
+    if not token_info:
+        raise Exception("Invalid or expired session_id. Please log in again via the web interface to get a new one.")
 
-        # Refresh token if expired and update the database
-        if SpotifyOAuth.is_token_expired(token_info):
-            sp_oauth = create_spotify_oauth()
-            token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
-            db_session.token_info = token_info
-            db.commit()
+    # Refresh token if (nearly) expired; the refresh also updates the database
+    if token_info["expires_at"] <= now + TOKEN_EXPIRY_MARGIN:
+        token_info = await refresh_session_token(session_id, token_info["refresh_token"])
 
-        return spotipy.Spotify(auth=token_info["access_token"])
-    finally:
-        db.close()
+    _cache_token(session_id, token_info)
+    _active_sessions.add(session_id)
+    return token_info["access_token"]
+
+async def refresh_expiring_tokens():
+    """
+    Background loop that refreshes the tokens of active sessions shortly before they
+    expire, so tool calls don't have to wait on a refresh themselves.
+    """
+    while True:
+        await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+        # Anything that would enter the expiry margin before the next pass is due now
+        deadline = time.time() + TOKEN_EXPIRY_MARGIN + TOKEN_REFRESH_INTERVAL
+        due = {
+            session_id: _token_cache[session_id]
+            for session_id in _active_sessions
+            if session_id in _token_cache and _token_cache[session_id].expires_at < deadline
+        }
+        if not due:
+            continue
+        # Calls made after this point mark the session active again for the next token
+        _active_sessions.difference_update(due)
+        results = await asyncio.gather(
+            *(refresh_session_token(session_id, entry.refresh_token) for session_id, entry in due.items()),
+            return_exceptions=True,
+        )
+        for session_id, token_info in zip(due, results):
+            # On failure, leave the entry alone; the next tool call retries the refresh
+            if not isinstance(token_info, BaseException):
+                _cache_token(session_id, token_info)
+
+# --- 3. SPOTIFY WEB API CLIENT ---
+
+# One shared async client so tool calls don't block the event loop on Spotify I/O.
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+)
+
+# Bounds this worker's concurrent Spotify calls so traffic bursts queue here instead of
+# tripping Spotify's per-app rate limit.
+SPOTIFY_ADMISSION = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENCY)
+
+async def spotify_api(token: str, method: str, path: str, **kwargs):
+    """Sends a request to the Spotify Web API and returns the decoded JSON body, if any."""
+    async with SPOTIFY_ADMISSION:
+        response = await HTTP.request(
+            method,
+            f"{SPOTIFY_API_URL}{path}",
+            headers={"Authorization": f"Bearer {token}"},
+            **kwargs,
+        )
+    response.raise_for_status()
+    if response.status_code == 204 or not response.content:
+        return None
+    return orjson.loads(response.content)
+
+async def request_token(data: dict) -> dict:
+    """
+    Posts a grant to Spotify's token endpoint on the shared client and returns the
+    token info, stamped with expires_at the same way spotipy does.
+    """
+    response = await HTTP.post(SPOTIFY_TOKEN_URL, data=data, auth=(CLIENT_ID, CLIENT_SECRET))
+    response.raise_for_status()
+    token_info = orjson.loads(response.content)
+    token_info["expires_at"] = int(time.time()) + token_info["expires_in"]
+    return token_info
+
+class Track(NamedTuple):
+    name: str
+    uri: str
+    artist: str
+
+# Lowercased query -> (top track or None, expires_at). Shared by every session, since the
+# same queries recur across users.
+_search_cache: dict[str, tuple[Track | None, float]] = {}
+# (session_id, lowercased query) -> in-flight search. Kept per session so one user's
+# revoked or rate-limited token can't fail another user's search.
+_search_inflight: dict[tuple[str, str], asyncio.Task] = {}
+SEARCH_CACHE_TTL = 3600
+SEARCH_CACHE_SIZE = 4096
+
+async def _search_and_cache(token: str, key: str, query: str) -> Track | None:
+    """Runs the track search for a query and stores its top result."""
+    results = await spotify_api(token, "GET", "/search", params={"q": query, "type": "track", "limit": 1})
+    items = results['tracks']['items']
+    track = Track(items[0]['name'], items[0]['uri'], items[0]['artists'][0]['name']) if items else None
+    # Re-insert at the end, so a refreshed key isn't the next one evicted
+    _search_cache.pop(key, None)
+    if len(_search_cache) >= SEARCH_CACHE_SIZE:
+        # Evict the least recently used entry
+        del _search_cache[next(iter(_search_cache))]
+    _search_cache[key] = (track, time.time() + SEARCH_CACHE_TTL)
+    return track
+
+async def search_first_track(token: str, session_id: str, query: str) -> Track | None:
+    """
+    Returns the top track result for a query, or None if there is none. Results are cached
+    for an hour, and concurrent searches for the same query in one session share a request.
+    """
+    key = query.strip().lower()
+    entry = _search_cache.get(key)
+    if entry and entry[1] > time.time():
+        # Move to the end, so eviction drops the least recently used query
+        _search_cache[key] = _search_cache.pop(key)
+        return entry[0]
+
+    inflight_key = (session_id, key)
+    task = _search_inflight.get(inflight_key)
+    if task is None:
+        task = asyncio.create_task(_search_and_cache(token, key, query))
+        _search_inflight[inflight_key] = task
+        task.add_done_callback(lambda _: _search_inflight.pop(inflight_key, None))
+    return await asyncio.shield(task)
 
-# --- 3. MCP SERVER AND TOOLS DEFINITION ---
+# session_id -> ({lowercased playlist name: playlist id}, expires_at)
+_playlists_cache: dict[str, tuple[dict[str, str], float]] = {}
+PLAYLISTS_CACHE_TTL = 300
+PLAYLISTS_CACHE_SIZE = 1_000
+PLAYLISTS_PAGE_SIZE = 50
+
+async def get_playlist_index(
+    token: str, session_id: str, refresh: bool = False
+) -> tuple[dict[str, str], bool]:
+    """
+    Returns a mapping of lowercased playlist names to playlist ids for the session, and
+    whether it was just fetched (every page of the user's playlists) rather than cached.
+    """
+    entry = _playlists_cache.get(session_id)
+    if entry and not refresh and entry[1] > time.time():
+        return entry[0], False
+
+    first = await spotify_api(token, "GET", "/me/playlists", params={"limit": PLAYLISTS_PAGE_SIZE})
+    pages = [first]
+    if first['next']:
+        # The first page tells us the total, so fetch the rest concurrently
+        pages += await asyncio.gather(*(
+            spotify_api(token, "GET", "/me/playlists", params={"limit": PLAYLISTS_PAGE_SIZE, "offset": offset})
+            for offset in range(PLAYLISTS_PAGE_SIZE, first['total'], PLAYLISTS_PAGE_SIZE)
+        ))
+
+    index = {}
+    for page in pages:
+        for p in page['items']:
+            index.setdefault(p['name'].lower(), p['id'])
+
+    _playlists_cache.pop(session_id, None)
+    if len(_playlists_cache) >= PLAYLISTS_CACHE_SIZE:
+        # Evict the oldest entry
+        del _playlists_cache[next(iter(_playlists_cache))]
+    _playlists_cache[session_id] = (index, time.time() + PLAYLISTS_CACHE_TTL)
+    return index, True
+
+async def close_http_client():
+    """Closes the shared Spotify HTTP client on server shutdown."""
+    await HTTP.aclose()
+
+# --- 4. MCP SERVER AND TOOLS DEFINITION ---
 mcp = FastMCP(
     "Public Spotify Controller",
-    description="A multi-user MCP server to control Spotify playback, playlists, and history."
+    description="A multi-user MCP server to control Spotify playback, playlists, and history.",
+    debug=DEBUG,
 )
 
+def tool_errors(fn):
+    """Turns an exception raised by a tool into the error message returned to the assistant."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        except httpx.HTTPStatusError as e:
+            try:
+                message = orjson.loads(e.response.content)["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                # Not a Spotify error body (e.g. an HTML error page from a proxy)
+                message = f"HTTP {e.response.status_code}"
+            return f"Spotify error: {message}"
+        except Exception as e:
+            return f"An error occurred: {e}"
+    return wrapper
+
 @mcp.tool()
-def search_and_play(session_id: str, query: str) -> str:
+@tool_errors
+async def search_and_play(session_id: str, query: str) -> str:
     """Searches for a song and plays the first result for the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        results = sp.search(q=query, type='track', limit=1)
-        if not results['tracks']['items']:
-            return f"No results found for '{query}'."
-        track = results['tracks']['items'][0]
-        track_uri = track['uri']
-        sp.start_playback(uris=[track_uri])
-        return f"Now playing: {track['name']} by {track['artists'][0]['name']}"
-    except Exception as e:
-        return f"An error occurred: {e}"
+    token = await get_token_for_session(session_id)
+    track = await search_first_track(token, session_id, query)
+    if not track:
+        return f"No results found for '{query}'."
+    await spotify_api(token, "PUT", "/me/player/play", json={"uris": [track.uri]})
+    return f"Now playing: {track.name} by {track.artist}"
 
 @mcp.tool()
-def pause_playback(session_id: str) -> str:
+@tool_errors
+async def pause_playback(session_id: str) -> str:
     """Pauses the current playback for the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        sp.pause_playback()
-        return "Playback paused."
-    except Exception as e:
-        return f"An error occurred: {e}"
+    token = await get_token_for_session(session_id)
+    await spotify_api(token, "PUT", "/me/player/pause")
+    return "Playback paused."
 
 @mcp.tool()
-def resume_playback(session_id: str) -> str:
+@tool_errors
+async def resume_playback(session_id: str) -> str:
     """Resumes the current playback for the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        sp.start_playback()
-        return "Playback resumed."
-    except Exception as e:
-        return f"An error occurred: {e}"
+    token = await get_token_for_session(session_id)
+    await spotify_api(token, "PUT", "/me/player/play")
+    return "Playback resumed."
 
 @mcp.tool()
-def next_track(session_id: str) -> str:
+@tool_errors
+async def next_track(session_id: str) -> str:
     """Skips to the next track for the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        sp.next_track()
-        return "Skipped to the next track."
-    except Exception as e:
-        return f"An error occurred: {e}"
+    token = await get_token_for_session(session_id)
+    await spotify_api(token, "POST", "/me/player/next")
+    return "Skipped to the next track."
 
 @mcp.tool()
-def get_current_song(session_id: str) -> str:
+@tool_errors
+async def get_current_song(session_id: str) -> str:
     """Gets the currently playing song and artist for the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        track_info = sp.current_playback()
-        if track_info and track_info['is_playing']:
-            item = track_info['item']
-            return f"Currently playing: {item['name']} by {item['artists'][0]['name']}"
-        else:
-            return "Nothing is currently playing."
-    except Exception as e:
-        return f"An error occurred: {e}"
+    token = await get_token_for_session(session_id)
+    track_info = await spotify_api(token, "GET", "/me/player/currently-playing")
+    if track_info and track_info['is_playing'] and track_info['item']:
+        item = track_info['item']
+        return f"Currently playing: {item['name']} by {item['artists'][0]['name']}"
+    else:
+        return "Nothing is currently playing."
 
 @mcp.tool()
-def get_my_playlists(session_id: str) -> str:
+@tool_errors
+async def get_my_playlists(session_id: str) -> str:
     """Retrieves all playlists for the user of the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        playlists = sp.current_user_playlists()
-        if not playlists['items']:
-            return "You don't have any playlists."
-        playlist_names = [p['name'] for p in playlists['items']]
-        return "Here are your playlists:\n" + "\n".join(f"- {name}" for name in playlist_names)
-    except Exception as e:
-        return f"An error occurred: {e}"
+    token = await get_token_for_session(session_id)
+    playlists = await spotify_api(token, "GET", "/me/playlists", params={"limit": 50})
+    if not playlists['items']:
+        return "You don't have any playlists."
+    return "Here are your playlists:\n" + "\n".join(f"- {p['name']}" for p in playlists['items'])
 
 @mcp.tool()
-def get_recently_played(session_id: str) -> str:
+@tool_errors
+async def get_recently_played(session_id: str) -> str:
     """Gets the last 5 recently played tracks for the user of the given session."""
-    sp = get_sp_for_session(session_id)
-    try:
-        results = sp.current_user_recently_played(limit=5)
-        if not results['items']:
-            return "You haven't played any tracks recently."
-        tracks = [f"{item['track']['name']} by {item['track']['artists'][0]['name']}" for item in results['items']]
-        return "Here are your recently played tracks:\n" + "\n".join(f"- {track}" for track in tracks)
-    except Exception as e:
-        return f"An error occurred: {e}"
-        
+    token = await get_token_for_session(session_id)
+    results = await spotify_api(token, "GET", "/me/player/recently-played", params={"limit": 5})
+    if not results['items']:
+        return "You haven't played any tracks recently."
+    return "Here are your recently played tracks:\n" + "\n".join(
+        f"- {item['track']['name']} by {item['track']['artists'][0]['name']}" for item in results['items']
+    )
+
 @mcp.tool()
-def add_to_playlist(session_id: str, song_query: str, playlist_name: str) -> str:
+@tool_errors
+async def add_to_playlist(session_id: str, song_query: str, playlist_name: str) -> str:
     """Searches for a song and adds it to one of the user's playlists."""
-    sp = get_sp_for_session(session_id)
-    try:
-        results = sp.search(q=song_query, type='track', limit=1)
-        if not results['tracks']['items']:
-            return f"Could not find the song: '{song_query}'."
-        track = results['tracks']['items'][0]
-        playlists = sp.current_user_playlists()
-        target_playlist = None
-        for p in playlists['items']:
-            if p['name'].lower() == playlist_name.lower():
-                target_playlist = p
-                break
-        if not target_playlist:
-            return f"Could not find a playlist named '{playlist_name}'."
-        sp.playlist_add_items(target_playlist['id'], [track['uri']])
-        return f"Successfully added '{track['name']}' to your '{playlist_name}' playlist."
-    except Exception as e:
-        return f"An error occurred: {e}"
-
-# --- 4. WEB SERVER (STARLETTE) ---
+    token = await get_token_for_session(session_id)
+    # The search and the playlist lookup are independent, so run them concurrently
+    track, (playlists, fresh) = await asyncio.gather(
+        search_first_track(token, session_id, song_query),
+        get_playlist_index(token, session_id),
+    )
+    if not track:
+        return f"Could not find the song: '{song_query}'."
+    playlist_id = playlists.get(playlist_name.lower())
+    if not playlist_id and not fresh:
+        # The cached listing may predate a newly created playlist
+        playlists, _ = await get_playlist_index(token, session_id, refresh=True)
+        playlist_id = playlists.get(playlist_name.lower())
+    if not playlist_id:
+        return f"Could not find a playlist named '{playlist_name}'."
+    await spotify_api(token, "POST", f"/playlists/{playlist_id}/tracks", json={"uris": [track.uri]})
+    return f"Successfully added '{track.name}' to your '{playlist_name}' playlist."
+
+@mcp.tool()
+@tool_errors
+async def add_to_playlist_by_id(session_id: str, song_query: str, playlist_id: str) -> str:
+    """
+    Searches for a song and adds it to the playlist with the given Spotify playlist ID.
+    A spotify:playlist: URI or an open.spotify.com playlist link is also accepted.
+    """
+    match = _PLAYLIST_ID_RE.fullmatch(playlist_id.strip())
+    if not match:
+        return f"'{playlist_id}' is not a valid Spotify playlist ID."
+    playlist_id = match.group(1)
+    token = await get_token_for_session(session_id)
+    track = await search_first_track(token, session_id, song_query)
+    if not track:
+        return f"Could not find the song: '{song_query}'."
+    await spotify_api(token, "POST", f"/playlists/{playlist_id}/tracks", json={"uris": [track.uri]})
+    return f"Successfully added '{track.name}' to playlist {playlist_id}."
+
+# --- 5. WEB SERVER (STARLETTE) ---
+
+# Success page for /callback, pre-encoded around the session_id slot
+_HTML_PREFIX = b"""<html>
+    <head><title>Authentication Successful</title>
+        <style>
+            body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; background-color: #121212; color: #ffffff; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; }
+            .container { background-color: #282828; padding: 40px; border-radius: 10px; text-align: center; box-shadow: 0 4px 20px rgba(0,0,0,0.5); max-width: 90%; }
+            h1 { color: #1DB954; } p { font-size: 1.1em; line-height: 1.6;}
+            code { background-color: #535353; padding: 15px; border-radius: 5px; font-family: monospace; user-select: all; word-break: break-all; display: inline-block; margin-top: 10px; font-size: 1.2em; }
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>Authentication Successful!</h1>
+            <p>Your session is now saved permanently. Copy your Session ID below and provide it to your AI assistant. You can now close this tab.</p>
+            <p><code>"""
+_HTML_SUFFIX = b"""</code></p>
+        </div>
+    </body>
+</html>
+"""
+
+async def root_redirect(request):
+    """Sends visitors of the bare domain to the login flow."""
+    return RedirectResponse(url='/login')
 
 async def login(request):
     """Redirects the user to Spotify's authorization page."""
-    sp_oauth = create_spotify_oauth()
-    auth_url = sp_oauth.get_authorize_url()
+    auth_url = SP_OAUTH.get_authorize_url()
     return RedirectResponse(url=auth_url)
 
 async def callback(request):
     """
     Handles the redirect, generates a session_id, and stores the token in the database.
     """
-    sp_oauth = create_spotify_oauth()
     code = request.query_params['code']
-    token_info = sp_oauth.get_access_token(code, as_dict=True)
+    token_info = await request_token({
+        "grant_type": "authorization_code",
+        "code": code,
+        "redirect_uri": REDIRECT_URI,
+    })
 
-    temp_sp = spotipy.Spotify(auth=token_info["access_token"])
-    user_profile = temp_sp.current_user()
-    
-    display_name = user_profile.get('display_name', 'user')
-    sanitized_name = re.sub(r'[^a-zA-Z0-9]', '-', display_name).lower()
-    random_id = random.randint(100, 999)
-    session_id = f"{sanitized_name}-{random_id}"
+    session_id = secrets.token_urlsafe(12)
 
     # --- NEW: Save session to database ---
-    db = SessionLocal()
+    # A single upsert: a returning user keeps their existing session_id
+    stmt = insert(SpotifySession).values(session_id=session_id, token_info=token_info)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[refresh_token_expr.self_group()],
+        set_={"token_info": stmt.excluded.token_info},
+    ).returning(SpotifySession.session_id)
+    async with engine.begin() as conn:
+        session_id = (await conn.execute(stmt)).scalar_one()
+
+    body = _HTML_PREFIX + session_id.encode() + _HTML_SUFFIX
+    return HTMLResponse(body)
+
+app = mcp.sse_app()
+app.router.routes.extend([
+    Route("/login", login),
+    Route("/", root_redirect, methods=['GET']),
+    Route("/callback", callback),
+])
+
+@asynccontextmanager
+async def lifespan(app):
+    """Prepares the database and token refresher on startup and releases everything on shutdown."""
+    await init_db()
+    token_refresher = asyncio.create_task(refresh_expiring_tokens())
     try:
-        # ** FINAL FIX: Use .as_string() for the correct JSON query syntax **
-        existing_session = db.query(SpotifySession).filter(
-            SpotifySession.token_info['refresh_token'].as_string() == token_info['refresh_token']
-        ).first()
-
-        if existing_session:
-            existing_session.token_info = token_info
-            session_id = existing_session.session_id # Reuse the existing session_id
-        else:
-            new_session = SpotifySession(session_id=session_id, token_info=token_info)
-            db.add(new_session)
-        db.commit()
+        yield
     finally:
-        db.close()
-
-    html_content = f"""
-    <html>
-        <head><title>Authentication Successful</title>
-            <style>
-                body {{ font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; background-color: #121212; color: #ffffff; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; }}
-                .container {{ background-color: #282828; padding: 40px; border-radius: 10px; text-align: center; box-shadow: 0 4px 20px rgba(0,0,0,0.5); max-width: 90%; }}
-                h1 {{ color: #1DB954; }} p {{ font-size: 1.1em; line-height: 1.6;}}
-                code {{ background-color: #535353; padding: 15px; border-radius: 5px; font-family: monospace; user-select: all; word-break: break-all; display: inline-block; margin-top: 10px; font-size: 1.2em; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Authentication Successful!</h1>
-                <p>Your session is now saved permanently. Copy your Session ID below and provide it to your AI assistant. You can now close this tab.</p>
-                <p><code>{session_id}</code></p>
-            </div>
-        </body>
-    </html>
-    """
-    return Response(html_content, media_type="text/html")
+        token_refresher.cancel()
+        await close_http_client()
+        await close_db()
 
-app = mcp.sse_app()
-app.add_route("/login", login)
-app.add_route("/", lambda req: RedirectResponse(url='/login'), methods=['GET'])
-app.add_route("/callback", callback)
+# sse_app() doesn't define a lifespan of its own
+app.router.lifespan_context = lifespan
 
 if __name__ == "__main__":
     print("Starting server. Please open http://localhost:8888/login in your browser to authenticate with Spotify.")
-    uvicorn.run(app, host="0.0.0.0", port=8888)
+    # MCP SSE sessions live in the memory of the worker that accepted GET /sse, so
+    # WEB_CONCURRENCY > 1 needs a proxy with sticky routing by session_id. Each worker
+    # also opens its own database pool.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8888,
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
+        log_level="warning",
+        access_log=False,
+    )